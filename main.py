@@ -5,12 +5,29 @@ Triggered weekly by EventBridge (CloudWatch Events)
 
 import os
 import json
-from datetime import datetime, timedelta
+import random
+import asyncio
+import functools
+import logging
+from datetime import datetime, timezone
+import niquests
+import numpy as np
 import pandas as pd
-from pytrends.request import TrendReq
+from google.api_core.exceptions import NotFound
 from google.cloud import bigquery
+from google.cloud.bigquery.enums import AutoRowIDs
 from google.oauth2 import service_account
-import time
+
+# uvloop ships in the Lambda layer; fall back to the default loop elsewhere (e.g. Windows)
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+logger = logging.getLogger(__name__)
+# Case-insensitive; unset, empty or unknown names fall back to INFO rather than failing at init
+LOG_LEVEL = os.getenv('LOG_LEVEL', '').strip().upper()
+logger.setLevel(LOG_LEVEL if LOG_LEVEL in logging.getLevelNamesMapping() else logging.INFO)
 
 # Configuration
 MARKETS_CONFIG = {
@@ -28,73 +45,281 @@ MARKETS_CONFIG = {
     'MO': {'geo_code': 'MO', 'keywords': ['pepperstone', 'exness', 'ic markets', 'xm', 'qrs', 'vantage', 'fx pro', 'fbs', 'hfm', 'tmgm']}
 }
 
+# (market, geo_code, keyword batch) per Trends request - keyword lists are
+# constants, so the plan is flattened once at import. Trends compares at most
+# 5 keywords per request.
+WORK_ITEMS = tuple(
+    (market, config['geo_code'], tuple(config['keywords'][i:i+5]))
+    for market, config in MARKETS_CONFIG.items()
+    for i in range(0, len(config['keywords']), 5)
+)
+
+# Fixed category lists so string columns are carried as int8 codes, not per-row objects
+MARKET_CATEGORIES = list(MARKETS_CONFIG)
+GEO_CATEGORIES = [config['geo_code'] for config in MARKETS_CONFIG.values()]
+KEYWORD_CATEGORIES = list(dict.fromkeys(kw for config in MARKETS_CONFIG.values() for kw in config['keywords']))
+
 PROJECT_ID = os.getenv('GCP_PROJECT_ID', 'keyword-planner-etl')
 DATASET_ID = os.getenv('BIGQUERY_DATASET', 'keyword_data')
 TABLE_ID = 'trends_data'
 
-def get_bigquery_client():
-    """Initialize BigQuery client with service account from environment variable"""
+TRENDS_SCHEMA = [
+    bigquery.SchemaField('date', 'TIMESTAMP', 'REQUIRED'),
+    bigquery.SchemaField('keyword', 'STRING', 'REQUIRED'),
+    bigquery.SchemaField('interest_score', 'INT64'),
+    bigquery.SchemaField('market', 'STRING'),
+    bigquery.SchemaField('geo_code', 'STRING'),
+    bigquery.SchemaField('extracted_at', 'TIMESTAMP')
+]
+
+# Daily partitions on date let the MAX(date) dedup lookup prune to recent partitions
+PARTITION_FIELD = 'date'
+CLUSTERING_FIELDS = ['market', 'keyword']
+
+# Batches smaller than this are streamed instead of going through a load job
+STREAMING_ROW_LIMIT = 1000
+
+TRENDS_BASE_URL = 'https://trends.google.com/trends'
+TRENDS_EXPLORE_URL = f'{TRENDS_BASE_URL}/api/explore'
+TRENDS_MULTILINE_URL = f'{TRENDS_BASE_URL}/api/widgetdata/multiline'
+TRENDS_HL = 'en-US'
+TRENDS_TZ = 480
+
+# Concurrent Trends requests in flight; keep low to stay under Google's 429 threshold
+MAX_CONCURRENT_REQUESTS = 4
+
+# Rate-limit (429) and server (5xx) responses are retried with exponential backoff
+MAX_FETCH_ATTEMPTS = 4
+RETRY_BACKOFF_SECONDS = 5
+
+# Reused across warm Lambda invocations (the execution context outlives a single call)
+_BQ = None
+_TRENDS_COOKIES = None
+
+@functools.lru_cache(maxsize=1)
+def _get_credentials():
+    """Parse the service account from environment variable once per container"""
     credentials_json = os.getenv('GCP_SERVICE_ACCOUNT_JSON')
     
     if not credentials_json:
         raise ValueError("GCP_SERVICE_ACCOUNT_JSON environment variable not set")
     
-    # Parse JSON credentials
+    # Parse JSON credentials (includes the private key PEM decode)
     credentials_info = json.loads(credentials_json)
-    credentials = service_account.Credentials.from_service_account_info(credentials_info)
+    return service_account.Credentials.from_service_account_info(credentials_info)
+
+def get_bigquery_client():
+    """Initialize BigQuery client with service account from environment variable"""
+    return bigquery.Client(credentials=_get_credentials(), project=PROJECT_ID)
+
+async def request_with_backoff(session, method, url, params):
+    """Send a Trends request, retrying 429 and 5xx responses with exponential backoff"""
+    for attempt in range(MAX_FETCH_ATTEMPTS):
+        response = await session.request(method, url, params=params)
+        
+        if response.status_code != 429 and response.status_code < 500:
+            break
+        
+        if attempt < MAX_FETCH_ATTEMPTS - 1:
+            delay = RETRY_BACKOFF_SECONDS * 2 ** attempt + random.uniform(0, 1)
+            logger.warning("Trends returned %s, retrying in %.1fs", response.status_code, delay)
+            await asyncio.sleep(delay)
     
-    return bigquery.Client(credentials=credentials, project=PROJECT_ID)
+    response.raise_for_status()
+    return response
 
-def get_trends_data(pytrends, keywords, geo_code, timeframe='now 7-d'):
-    """Fetch Google Trends data for keywords in a specific market"""
+async def fetch_widget(session, semaphore, geo_code, keywords, timeframe='now 7-d'):
+    """Fetch the raw interest-over-time widget response for keywords in a specific market"""
+    token_payload = {
+        'hl': TRENDS_HL,
+        'tz': TRENDS_TZ,
+        'req': json.dumps({
+            'comparisonItem': [{'keyword': kw, 'time': timeframe, 'geo': geo_code} for kw in keywords],
+            'category': 0,
+            'property': ''
+        })
+    }
+    
+    # Retries back off inside the slot, so a rate-limited batch also slows the others
+    async with semaphore:
+        try:
+            # Explore call returns the widget tokens (response prefixed with ")]}'")
+            response = await request_with_backoff(session, 'POST', TRENDS_EXPLORE_URL, token_payload)
+            widgets = json.loads(response.content[4:])['widgets']
+            widget = next(w for w in widgets if w['id'] == 'TIMESERIES')
+            
+            # Multiline call returns the timeline itself (response prefixed with ")]}',")
+            response = await request_with_backoff(session, 'GET', TRENDS_MULTILINE_URL, {
+                'req': json.dumps(widget['request']),
+                'token': widget['token'],
+                'tz': TRENDS_TZ
+            })
+            return response.content[5:]
+            
+        except Exception as e:
+            logger.error("Error fetching trends for %s: %s", geo_code, e)
+            return None
+        
+        finally:
+            # Rate limiting - hold the slot for a jittered pause before releasing it
+            await asyncio.sleep(random.uniform(1, 2))
+
+def parse_widget(json_bytes, keywords):
+    """Parse an interest-over-time widget response into wide (dates, date x keyword scores) arrays"""
     try:
-        pytrends.build_payload(
-            kw_list=keywords,
-            cat=0,
-            timeframe=timeframe,
-            geo=geo_code,
-            gprop=''
-        )
+        timeline = json.loads(json_bytes)['default']['timelineData']
         
-        interest_over_time = pytrends.interest_over_time()
+        # No search volume is a valid (empty) result, not a failure
+        if not timeline:
+            return np.array([], dtype='datetime64[ns]'), np.empty((0, len(keywords)), dtype=np.int8)
         
-        if interest_over_time.empty:
-            return pd.DataFrame()
+        # Read only 'time' and 'value' - isPartial, hasData and the formatted
+        # strings are never materialized, so there is nothing to drop later
+        dates = np.array([int(point['time']) for point in timeline], dtype='datetime64[s]').astype('datetime64[ns]')
+        # Trends scores are 0-100, so int8 holds them (BigQuery still stores INT64)
+        vals = np.array([point['value'] for point in timeline], dtype=np.int8)
         
-        if 'isPartial' in interest_over_time.columns:
-            interest_over_time = interest_over_time.drop('isPartial', axis=1)
+        return dates, vals
         
-        df_long = interest_over_time.reset_index().melt(
-            id_vars=['date'],
-            var_name='keyword',
-            value_name='interest_score'
-        )
+    except Exception as e:
+        logger.error("Error parsing trends for %s: %s", ', '.join(keywords), e)
+        return None
+
+def build_long_format(wide_frames):
+    """Reshape all (market, geo_code, keywords, dates, vals) batches into one long-format DataFrame"""
+    markets, geo_codes, batches, dates_per_batch, vals_per_batch = zip(*wide_frames)
+    sizes = [vals.size for vals in vals_per_batch]
+    
+    # Row-major ravel: each date repeated once per keyword, keywords cycled per date
+    dates = np.concatenate([np.repeat(d, len(kws)) for d, kws in zip(dates_per_batch, batches)])
+    keywords = np.concatenate([np.tile(np.asarray(kws), len(d)) for d, kws in zip(dates_per_batch, batches)])
+    
+    # Trends timestamps are UTC epochs; tz-aware columns map to BigQuery TIMESTAMP
+    return pd.DataFrame({
+        'date': pd.DatetimeIndex(dates).tz_localize('UTC'),
+        'keyword': pd.Categorical(keywords, categories=KEYWORD_CATEGORIES),
+        'interest_score': np.concatenate([vals.ravel() for vals in vals_per_batch]),
+        'market': pd.Categorical(np.repeat(markets, sizes), categories=MARKET_CATEGORIES),
+        'geo_code': pd.Categorical(np.repeat(geo_codes, sizes), categories=GEO_CATEGORIES),
+        'extracted_at': datetime.now(timezone.utc)
+    })
+
+async def fetch_and_parse(session, semaphore, market, geo_code, keywords, timeframe='now 7-d'):
+    """Fetch one keyword batch and parse it into wide arrays"""
+    payload = await fetch_widget(session, semaphore, geo_code, keywords, timeframe)
+    
+    if payload is None:
+        return None
+    
+    wide = parse_widget(payload, keywords)
+    
+    if wide is not None:
+        logger.info("  %s: retrieved %d data points for %s", market, wide[1].size, ', '.join(keywords))
+    
+    return wide
+
+async def fetch_all_trends(timeframe='now 7-d'):
+    """Fetch every market's keyword batches concurrently, returning wide arrays in WORK_ITEMS order"""
+    global _TRENDS_COOKIES
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    
+    async with niquests.AsyncSession() as session:
+        session.headers.update({'accept-language': TRENDS_HL})
         
-        return df_long
+        # Google requires an NID cookie before it will hand out widget tokens;
+        # negotiate it once per container rather than on every invocation
+        if not _TRENDS_COOKIES:
+            await session.get(f'{TRENDS_BASE_URL}/?geo={TRENDS_HL[-2:]}')
+            _TRENDS_COOKIES = session.cookies.get_dict()
+        else:
+            session.cookies.update(_TRENDS_COOKIES)
         
-    except Exception as e:
-        print(f"Error fetching trends for {geo_code}: {e}")
-        return pd.DataFrame()
+        return await asyncio.gather(*(
+            fetch_and_parse(session, semaphore, market, geo_code, batch, timeframe)
+            for market, geo_code, batch in WORK_ITEMS
+        ))
 
-def get_latest_date_in_bigquery(bq_client):
-    """Check the latest date already in BigQuery to avoid duplicates"""
+def submit_latest_date_query(bq_client):
+    """Start the latest-date query without waiting, so it overlaps the Trends fetches"""
     table_ref = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}"
     
+    # Only the 7-day Trends window can collide with existing rows, so scanning
+    # the last few partitions is enough; older data means nothing overlaps
+    query = f"""
+        SELECT MAX(DATE(date)) as max_date FROM `{table_ref}`
+        WHERE date >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 8 DAY)
+    """
+    return bq_client.query(query)
+
+def get_latest_date_in_bigquery(query_job):
+    """Check the latest date already in BigQuery to avoid duplicates"""
     try:
-        query = f"SELECT MAX(DATE(date)) as max_date FROM `{table_ref}`"
-        result = bq_client.query(query).result()
-        max_date = list(result)[0].max_date
-        
-        if max_date:
-            print(f"Latest date in BigQuery: {max_date}")
-            return max_date
-        else:
-            print("No existing data in BigQuery")
-            return None
-    except Exception as e:
-        print(f"Could not check existing data: {e}")
+        result = query_job.result()
+    except NotFound:
+        # First run - the table is created on load
+        logger.info("No existing data in BigQuery")
+        return None
+    # Any other failure propagates: loading without the lookup would insert duplicates
+    
+    max_date = list(result)[0].max_date
+    
+    if max_date:
+        logger.info("Latest date in BigQuery: %s", max_date)
+        return max_date
+    else:
+        logger.info("No existing data in BigQuery")
         return None
 
+def build_trends_table():
+    """Table definition used when the destination table has to be created"""
+    table = bigquery.Table(f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}", schema=TRENDS_SCHEMA)
+    table.time_partitioning = bigquery.TimePartitioning(
+        type_=bigquery.TimePartitioningType.DAY,
+        field=PARTITION_FIELD
+    )
+    table.clustering_fields = CLUSTERING_FIELDS
+    return table
+
+def load_to_bigquery(bq_client, df):
+    """Append rows to BigQuery - streaming insert for small batches, load job otherwise"""
+    # Create the table up front so streaming inserts have a target and new
+    # tables pick up the partitioning spec; no-op when it already exists
+    table = bq_client.create_table(build_trends_table(), exists_ok=True)
+    
+    if len(df) < STREAMING_ROW_LIMIT:
+        # One insertAll request for the whole frame (far below the 50k-row /
+        # 10 MB request limits), so the insert is all-or-nothing like the load
+        # job: rows are in market order, and a partial insert would leave
+        # dates that the next run's MAX(date) skips for the missing markets.
+        # Invalid rows fail the whole request (skipInvalidRows defaults false).
+        # No insertId, so BigQuery can't drop a resent request's rows. Client
+        # retries are off too: a retry of a request the server already
+        # committed would write those rows twice. A transient failure fails
+        # the run with nothing written, and the next run reloads the window.
+        chunk_errors = bq_client.insert_rows_from_dataframe(
+            table,
+            df,
+            chunk_size=len(df),
+            row_ids=AutoRowIDs.DISABLED,
+            retry=None
+        )
+        errors = [error for chunk in chunk_errors for error in chunk]
+        
+        if errors:
+            raise RuntimeError(f"Streaming insert failed for {len(errors)} rows: {errors[:3]}")
+        return
+    
+    job_config = bigquery.LoadJobConfig(
+        write_disposition="WRITE_APPEND",
+        schema=TRENDS_SCHEMA,
+        autodetect=False
+    )
+    
+    # One job keeps the append all-or-nothing: rows are in market order, not date
+    # order, so a partial load would leave dates that MAX(date) then skips forever
+    job = bq_client.load_table_from_dataframe(df, table, job_config=job_config)
+    job.result()
+
 def lambda_handler(event, context):
     """
     AWS Lambda handler function
@@ -107,91 +332,89 @@ def lambda_handler(event, context):
     Returns:
         dict: Response with statusCode and body
     """
-    print(f"Starting Google Trends ETL - {datetime.now()}")
-    print(f"Event: {json.dumps(event)}")
+    logger.info("Starting Google Trends ETL - %s", datetime.now())
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Event: %s", json.dumps(event))
     
     try:
-        # Initialize clients
-        pytrends = TrendReq(hl='en-US', tz=480)
-        bq_client = get_bigquery_client()
+        # Initialize clients (kept at module scope for warm starts)
+        global _BQ
+        _BQ = _BQ or get_bigquery_client()
+        bq_client = _BQ
         
-        all_trends_data = []
+        # Independent of the Trends fetches, so let it run in the background
+        latest_date_job = submit_latest_date_query(bq_client)
         
-        # Extract data from all markets
-        for market, config in MARKETS_CONFIG.items():
-            print(f"Processing {market}...")
-            
-            keywords = config['keywords']
-            geo_code = config['geo_code']
-            
-            # Split into batches of 5 keywords
-            for i in range(0, len(keywords), 5):
-                batch = keywords[i:i+5]
-                
-                df = get_trends_data(pytrends, batch, geo_code, timeframe='now 7-d')
-                
-                if not df.empty:
-                    df['market'] = market
-                    df['geo_code'] = geo_code
-                    df['extracted_at'] = datetime.utcnow()
-                    all_trends_data.append(df)
-                    print(f"  Retrieved {len(df)} data points for {', '.join(batch)}")
-                
-                # Rate limiting
-                time.sleep(2)
-        
-        if not all_trends_data:
-            print("No data extracted")
+        # Extract data from all markets concurrently
+        if uvloop is not None:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        results = asyncio.run(fetch_all_trends(timeframe='now 7-d'))
+        
+        # A partial load would move MAX(date) past the failed batches' dates and
+        # they'd never be backfilled, so load nothing unless every batch succeeded
+        failed = [(market, batch) for (market, _, batch), wide in zip(WORK_ITEMS, results) if wide is None]
+        
+        if failed:
+            logger.error("Failed to fetch %d of %d batches: %s", len(failed), len(WORK_ITEMS), failed)
+            return {
+                'statusCode': 500,
+                'body': json.dumps(f'Error: failed to fetch {len(failed)} of {len(WORK_ITEMS)} batches')
+            }
+        
+        # gather preserves order, so results line up with WORK_ITEMS by index
+        wide_frames = [
+            (market, geo_code, batch, *wide)
+            for (market, geo_code, batch), wide in zip(WORK_ITEMS, results)
+            if wide[1].size
+        ]
+        
+        if not wide_frames:
+            logger.info("No data extracted")
             return {
                 'statusCode': 200,
                 'body': json.dumps('No data extracted')
             }
         
-        # Combine all data
-        combined_trends = pd.concat(all_trends_data, ignore_index=True)
+        # Combine all data - reshaped to long format once, across every batch
+        combined_trends = build_long_format(wide_frames)
+        
+        # Check for existing data first so both filters fuse into one mask
+        latest_date = get_latest_date_in_bigquery(latest_date_job)
         
-        # Filter out incomplete current week (last 3 days)
-        combined_trends['date'] = pd.to_datetime(combined_trends['date'])
-        cutoff_date = datetime.now() - timedelta(days=3)
-        combined_trends = combined_trends[combined_trends['date'] < cutoff_date]
+        # Filter out incomplete current week (last 3 days) and dates already loaded
+        # 'date'.values is UTC datetime64[ns]; compare in datetime64 to stay vectorized
+        dates = combined_trends['date'].values
+        cutoff_date = np.datetime64('now') - np.timedelta64(3, 'D')
+        mask = dates < cutoff_date
         
-        if combined_trends.empty:
-            print("No complete week data available")
+        if not mask.any():
+            logger.info("No complete week data available")
             return {
                 'statusCode': 200,
                 'body': json.dumps('No complete week data available')
             }
         
-        # Check for existing data and filter duplicates
-        latest_date = get_latest_date_in_bigquery(bq_client)
-        
         if latest_date:
-            df_new = combined_trends[combined_trends['date'].dt.date > latest_date]
+            complete_rows = int(mask.sum())
+            next_date = np.datetime64(latest_date) + np.timedelta64(1, 'D')
+            mask &= dates >= next_date
             
-            if df_new.empty:
-                print("No new data to load (all dates already exist)")
+            if not mask.any():
+                logger.info("No new data to load (all dates already exist)")
                 return {
                     'statusCode': 200,
                     'body': json.dumps('No new data - all dates already exist in BigQuery')
                 }
             
-            print(f"Filtered {len(combined_trends)} rows to {len(df_new)} new rows")
-            combined_trends = df_new
+            logger.info("Filtered %d rows to %d new rows", complete_rows, mask.sum())
         
-        # Load to BigQuery
-        table_ref = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}"
+        combined_trends = combined_trends[mask]
         
-        job_config = bigquery.LoadJobConfig(
-            write_disposition="WRITE_APPEND",
-            schema_update_options=[bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION],
-            autodetect=True
-        )
-        
-        print(f"Loading {len(combined_trends)} rows to BigQuery...")
-        job = bq_client.load_table_from_dataframe(combined_trends, table_ref, job_config=job_config)
-        job.result()
+        # Load to BigQuery
+        logger.info("Loading %d rows to BigQuery...", len(combined_trends))
+        load_to_bigquery(bq_client, combined_trends)
         
-        print(f"Successfully loaded {len(combined_trends)} rows")
+        logger.info("Successfully loaded %d rows", len(combined_trends))
         
         return {
             'statusCode': 200,
@@ -199,7 +422,7 @@ def lambda_handler(event, context):
         }
         
     except Exception as e:
-        print(f"Error in Lambda execution: {str(e)}")
+        logger.error("Error in Lambda execution: %s", e)
         return {
             'statusCode': 500,
             'body': json.dumps(f'Error: {str(e)}')
@@ -208,6 +431,9 @@ def lambda_handler(event, context):
 
 # For local testing
 if __name__ == "__main__":
+    # Lambda attaches its own log handler; locally we need one
+    logging.basicConfig()
+    
     # Load environment from .env file for local testing
     from dotenv import load_dotenv
     load_dotenv()
@@ -217,4 +443,4 @@ if __name__ == "__main__":
     test_context = {}
     
     result = lambda_handler(test_event, test_context)
-    print(result)
+    logger.info("%s", result)